@@ -2,7 +2,6 @@
 # -*- coding: utf-8 -*-
 
 import wx
-from time import sleep
 from os.path import split, abspath
 from os import name as os_name
 
@@ -221,8 +220,8 @@ class MainWindow(wx.Frame):
                 # Use it with care.
                 progressdlg.Show()
                 while not scanner.finished:
-                    sleep(0.001)
-                    result = scanner.get_last_result()
+                    # Don't wait too long, the dialog has to be updated
+                    result = scanner.get_last_result(timeout=0.1)
 
                     if result:
                         counter += 1
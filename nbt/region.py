@@ -328,16 +328,19 @@ class RegionFile(object):
         elif self.size < 2*SECTOR_LENGTH:
             raise NoRegionHeader('The region file is %d bytes, too small in size to have a header.' % self.size)
         
-        for index in range(0, SECTOR_LENGTH, 4):
-            x = int(index//4) % 32
-            z = int(index//4)//32
+        # Read the locations and timestamps tables at once
+        self.file.seek(0)
+        locations = unpack(">1024I", self.file.read(SECTOR_LENGTH))
+        timestamps = unpack(">1024I", self.file.read(SECTOR_LENGTH))
+
+        for index in range(1024):
+            x = index % 32
+            z = index // 32
             m = self.metadata[x, z]
             
-            self.file.seek(index)
-            offset, length = unpack(">IB", b"\0" + self.file.read(4))
+            offset, length = locations[index] >> 8, locations[index] & 0xFF
             m.blockstart, m.blocklength = offset, length
-            self.file.seek(index + SECTOR_LENGTH)
-            m.timestamp = unpack(">I", self.file.read(4))[0]
+            m.timestamp = timestamps[index]
             
             if offset == 0 and length == 0:
                 m.status = STATUS_CHUNK_NOT_CREATED
@@ -529,6 +532,17 @@ class RegionFile(object):
         even if it is shorter than what is specified in the header (e.g. in case
         of a truncated while and non-compressed data).
         """
+        chunk = self.read_blockdata(x, z)
+        return self.decompress_blockdata(x, z, chunk)
+
+    def read_blockdata(self, x, z):
+        """
+        Return the binary data representing a chunk as stored in the file,
+        without decompressing it.
+        
+        May raise a RegionFileFormatError().
+        Use decompress_blockdata() to get the same data as get_blockdata().
+        """
         # read metadata block
         m = self.metadata[x, z]
         if m.status == STATUS_CHUNK_NOT_CREATED:
@@ -558,8 +572,24 @@ class RegionFile(object):
             # Do not read past the length of the file.
             # The length in the file includes the compression byte, hence the -1.
             length = min(m.length - 1, self.size - (m.blockstart * SECTOR_LENGTH + 5))
-            chunk = self.file.read(length)
-            
+            return self.file.read(length)
+        except Exception as e:
+            # Deliberately catch the Exception and re-raise.
+            err = '%s' % e # avoid str(e) due to Unicode issues in Python 2.
+        if err:
+            self._raise_blockdata_error(x, z, err)
+
+    def decompress_blockdata(self, x, z, chunk):
+        """
+        Return the decompressed binary data of a chunk, given the data as
+        returned by read_blockdata().
+        
+        May raise a RegionFileFormatError().
+        It doesn't read from the file, so it can be called from other threads.
+        """
+        m = self.metadata[x, z]
+        err = None
+        try:
             if (m.compression == COMPRESSION_GZIP):
                 # Python 3.1 and earlier do not yet support gzip.decompress(chunk)
                 f = gzip.GzipFile(fileobj=BytesIO(chunk))
@@ -578,15 +608,20 @@ class RegionFile(object):
             # The details in gzip/zlib/nbt are irrelevant, just that the data is garbled.
             err = '%s' % e # avoid str(e) due to Unicode issues in Python 2.
         if err:
-            # don't raise during exception handling to avoid the warning 
-            # "During handling of the above exception, another exception occurred".
-            # Python 3.3 solution (see PEP 409 & 415): "raise ChunkDataError(str(e)) from None"
-            if m.status == STATUS_CHUNK_MISMATCHED_LENGTHS:
-                raise ChunkHeaderError('The length in region header and the length in the header of chunk %d,%d are incompatible' % (x,z))
-            elif m.status == STATUS_CHUNK_OVERLAPPING:
-                raise ChunkHeaderError('Chunk %d,%d is overlapping with another chunk' % (x,z))
-            else:
-                raise ChunkDataError(err)
+            self._raise_blockdata_error(x, z, err)
+
+    def _raise_blockdata_error(self, x, z, err):
+        """Raise the RegionFileFormatError for garbled data of a chunk, based on its status."""
+        # don't raise during exception handling to avoid the warning 
+        # "During handling of the above exception, another exception occurred".
+        # Python 3.3 solution (see PEP 409 & 415): "raise ChunkDataError(str(e)) from None"
+        m = self.metadata[x, z]
+        if m.status == STATUS_CHUNK_MISMATCHED_LENGTHS:
+            raise ChunkHeaderError('The length in region header and the length in the header of chunk %d,%d are incompatible' % (x,z))
+        elif m.status == STATUS_CHUNK_OVERLAPPING:
+            raise ChunkHeaderError('Chunk %d,%d is overlapping with another chunk' % (x,z))
+        else:
+            raise ChunkDataError(err)
 
     def get_nbt(self, x, z):
         """
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+#   Region Fixer.
+#   Fix your region files with a backup copy of your Minecraft world.
+#   Copyright (C) 2020  Alejandro Aguilera (Fenixin)
+#   https://github.com/Fenixin/Minecraft-Region-Fixer
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+""" Lazy parser for the NBT data of the chunks.
+
+To scan a chunk we only need a few tags near the root of the NBT tree
+(DataVersion, Level, xPos, zPos, Position and the lengths of the entities
+lists), but nbt.NBTFile creates an object for every tag in the chunk.
+The functions in here walk the whole NBT data, so any error found by
+nbt.NBTFile is raised here too, but they only create objects for the tags
+in the root compound and in the compounds directly inside it. Lists only
+keep their length and byte and long arrays and deeper compounds are
+skipped.
+
+"""
+
+from struct import Struct, error as StructError
+
+import nbt.nbt as nbt
+from nbt.nbt import MalformedFileError
+from nbt.region import ChunkDataError
+from mutf8 import decode_modified_utf8
+
+
+_BYTE = Struct(">b")
+_SHORT = Struct(">h")
+_INT = Struct(">i")
+
+# Size in bytes of the payload of the numeric tags
+_NUMERIC_SIZE = {nbt.TAG_BYTE: 1,
+                 nbt.TAG_SHORT: 2,
+                 nbt.TAG_INT: 4,
+                 nbt.TAG_LONG: 8,
+                 nbt.TAG_FLOAT: 4,
+                 nbt.TAG_DOUBLE: 8}
+
+# Size in bytes of each element of the int and long arrays
+_ARRAY_ITEM_SIZE = {nbt.TAG_INT_ARRAY: 4,
+                    nbt.TAG_LONG_ARRAY: 8}
+
+# Compounds deeper than this are skipped
+_MAX_DEPTH = 1
+
+
+class SkippedTag(nbt.TAG):
+    """ A tag whose payload has been skipped by the lazy parser.
+
+    Inputs:
+     - tag_id -- Integer, the type of the skipped tag
+     - name -- String with the name of the tag
+
+    """
+
+    def __init__(self, tag_id, name):
+        super(SkippedTag, self).__init__(name=name)
+        self.id = tag_id
+
+
+def _check_string(raw):
+    """ Raise UnicodeDecodeError if raw is not valid modified UTF-8. """
+
+    # The pure python decoder is slow, plain ASCII without NULL bytes
+    # is always valid
+    if not raw.isascii() or b"\0" in raw:
+        decode_modified_utf8(raw)
+
+
+def _read_string(data, pos):
+    """ Return the string starting at pos and the position after it. """
+
+    length = _SHORT.unpack_from(data, pos)[0]
+    pos += 2
+    end = pos + length
+    if length < 0 or end > len(data):
+        raise StructError()
+    raw = data[pos:end]
+    if raw.isascii() and b"\0" not in raw:
+        return raw.decode("ascii"), end
+    return decode_modified_utf8(raw), end
+
+
+def _skip_string(data, pos):
+    """ Check the string starting at pos and return the position after it. """
+
+    length = _SHORT.unpack_from(data, pos)[0]
+    pos += 2
+    end = pos + length
+    if length < 0 or end > len(data):
+        raise StructError()
+    _check_string(data[pos:end])
+    return end
+
+
+def _skip_list_items(data, pos, item_id, length):
+    """ Skip the items of a list and return the position after them. """
+
+    if length <= 0:
+        return pos
+    # The same errors raised by nbt.TAG_List
+    if item_id not in nbt.TAGLIST:
+        raise KeyError(item_id)
+    if item_id == nbt.TAG_END:
+        raise TypeError("A list can't contain Tag End items")
+
+    size = _NUMERIC_SIZE.get(item_id)
+    if size is not None:
+        end = pos + size * length
+        if end > len(data):
+            raise StructError()
+        return end
+
+    for _ in range(length):
+        pos = _skip_payload(data, pos, item_id)
+    return pos
+
+
+def _skip_payload(data, pos, tag_id):
+    """ Check the payload of a tag and return the position after it. """
+
+    size = _NUMERIC_SIZE.get(tag_id)
+    if size is not None:
+        end = pos + size
+        if end > len(data):
+            raise StructError()
+        return end
+
+    elif tag_id == nbt.TAG_COMPOUND:
+        while True:
+            child_id = _BYTE.unpack_from(data, pos)[0]
+            pos += 1
+            if child_id == nbt.TAG_END:
+                return pos
+            pos = _skip_string(data, pos)
+            if child_id not in nbt.TAGLIST:
+                raise ValueError("Unrecognised tag type %d" % child_id)
+            pos = _skip_payload(data, pos, child_id)
+
+    elif tag_id == nbt.TAG_LIST:
+        item_id = _BYTE.unpack_from(data, pos)[0]
+        length = _INT.unpack_from(data, pos + 1)[0]
+        return _skip_list_items(data, pos + 5, item_id, length)
+
+    elif tag_id == nbt.TAG_STRING:
+        return _skip_string(data, pos)
+
+    elif tag_id == nbt.TAG_BYTE_ARRAY:
+        length = _INT.unpack_from(data, pos)[0]
+        pos += 4
+        # Like in nbt.TAG_Byte_Array, a short read is not an error
+        if length < 0:
+            return len(data)
+        return min(pos + length, len(data))
+
+    elif tag_id in _ARRAY_ITEM_SIZE:
+        length = _INT.unpack_from(data, pos)[0]
+        pos += 4
+        end = pos + _ARRAY_ITEM_SIZE[tag_id] * length
+        if length < 0 or end > len(data):
+            raise StructError()
+        return end
+
+    raise ValueError("Unrecognised tag type %d" % tag_id)
+
+
+def _read_payload(data, pos, tag_id, name, depth):
+    """ Return the tag starting at pos and the position after it.
+
+    Inputs:
+     - data -- Bytes with the NBT data
+     - pos -- Integer, position of the payload of the tag in data
+     - tag_id -- Integer, the type of the tag
+     - name -- String, name of the tag
+     - depth -- Integer, depth of the tag in the NBT tree
+
+    """
+
+    if tag_id in _NUMERIC_SIZE:
+        tag_class = nbt.TAGLIST[tag_id]
+        value = tag_class.fmt.unpack_from(data, pos)[0]
+        return tag_class(value=value, name=name), pos + _NUMERIC_SIZE[tag_id]
+
+    elif tag_id == nbt.TAG_STRING:
+        value, pos = _read_string(data, pos)
+        return nbt.TAG_String(value=value, name=name), pos
+
+    elif tag_id == nbt.TAG_LIST:
+        item_id = _BYTE.unpack_from(data, pos)[0]
+        length = _INT.unpack_from(data, pos + 1)[0]
+        pos = _skip_list_items(data, pos + 5, item_id, length)
+        # Only the length of the list is kept
+        tag = nbt.TAG_List(name=name)
+        tag.tagID = item_id
+        tag.tags = [None] * max(length, 0)
+        return tag, pos
+
+    elif tag_id == nbt.TAG_INT_ARRAY:
+        length = _INT.unpack_from(data, pos)[0]
+        fmt = Struct(">" + str(length) + "i")
+        tag = nbt.TAG_Int_Array(name=name)
+        tag.value = list(fmt.unpack_from(data, pos + 4))
+        return tag, pos + 4 + fmt.size
+
+    elif tag_id == nbt.TAG_COMPOUND and depth <= _MAX_DEPTH:
+        return _read_compound(data, pos, name, depth)
+
+    return SkippedTag(tag_id, name), _skip_payload(data, pos, tag_id)
+
+
+def _read_compound(data, pos, name, depth):
+    """ Return the compound starting at pos and the position after it. """
+
+    compound = nbt.TAG_Compound(name=name)
+    tags = compound.tags
+    while True:
+        child_id = _BYTE.unpack_from(data, pos)[0]
+        pos += 1
+        if child_id == nbt.TAG_END:
+            return compound, pos
+        child_name, pos = _read_string(data, pos)
+        if child_id not in nbt.TAGLIST:
+            raise ValueError("Unrecognised tag type %d" % child_id)
+        tag, pos = _read_payload(data, pos, child_id, child_name, depth + 1)
+        tags.append(tag)
+
+
+def parse_chunk(data):
+    """ Lazily parse the decompressed NBT data of a chunk.
+
+    Inputs:
+     - data -- Bytes with the decompressed NBT data
+
+    Return:
+     - chunk -- nbt.TAG_Compound with the root of the NBT tree
+
+    Raises the same exceptions as nbt.NBTFile would raise for the same data.
+
+    """
+
+    try:
+        tag_id = _BYTE.unpack_from(data, 0)[0]
+        if tag_id != nbt.TAG_COMPOUND:
+            raise MalformedFileError("First record is not a Compound Tag")
+        name, pos = _read_string(data, 1)
+        chunk, pos = _read_compound(data, pos, name, 0)
+        return chunk
+    except StructError:
+        raise MalformedFileError(
+            "Partial File Parse: file possibly truncated.")
+
+
+def get_chunk(region_file, x, z, data=None):
+    """ Like RegionFile.get_chunk() but parsing the chunk with parse_chunk().
+
+    Inputs:
+     - region_file -- nbt.RegionFile object
+     - x, z -- Integers, local coordinates of the chunk in the region file
+     - data -- Bytes with the decompressed data of the chunk, if None it is
+               read with region_file.get_blockdata()
+
+    Return:
+     - chunk -- nbt.TAG_Compound with the root of the NBT tree
+
+    Raises InconceivedChunk if the chunk is not created and any other
+    RegionFileFormatError if the chunk cannot be read.
+
+    """
+
+    if data is None:
+        data = region_file.get_blockdata(x, z)
+    try:
+        return parse_chunk(data)
+    except MalformedFileError as e:
+        raise ChunkDataError(str(e))
@@ -25,9 +25,13 @@
 import sys
 import logging
 import multiprocessing
-from os.path import split, abspath, join
-from time import sleep, time
-from copy import copy
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from operator import itemgetter
+from io import BytesIO
+from os.path import abspath, join, getsize
+from time import time
 from traceback import extract_tb
 
 import nbt.region as region
@@ -43,6 +47,7 @@ from progressbar import ProgressBar, Bar, AdaptiveETA, SimpleProgress
 import regionfixer_core.constants as c
 from regionfixer_core.util import entitle
 from regionfixer_core import world
+from regionfixer_core import lazy_nbt
 
 
 
@@ -125,70 +130,49 @@ def multiprocess_scan_data(data):
     """ Does the multithread stuff for scan_data """
     # Protect everything so an exception will be returned from the worker
     try:
-        result = scan_data(data)
-        multiprocess_scan_data.q.put(result)
+        return scan_data(data)
     except KeyboardInterrupt as e:
         raise e
     except:
         except_type, except_class, tb = sys.exc_info()
-        s = (data, (except_type, except_class, extract_tb(tb)))
-        multiprocess_scan_data.q.put(s)
+        return (data, (except_type, except_class, extract_tb(tb)))
 
 
-def multiprocess_scan_regionfile(region_file):
+def multiprocess_scan_regionfile(region_file, entity_limit, remove_entities,
+                                 threaded_decompression=False):
     """ Does the multithread stuff for scan_region_file """
     # Protect everything so an exception will be returned from the worker
     try:
-        r = region_file
-        entity_limit = multiprocess_scan_regionfile.entity_limit
-        remove_entities = multiprocess_scan_regionfile.remove_entities
-        # call the normal scan_region_file with this parameters
-        r = scan_region_file(r, entity_limit, remove_entities)
-        multiprocess_scan_regionfile.q.put(r)
+        return scan_region_file(region_file, entity_limit, remove_entities,
+                                threaded_decompression)
     except KeyboardInterrupt as e:
         raise e
     except:
         except_type, except_class, tb = sys.exc_info()
-        s = (region_file, (except_type, except_class, extract_tb(tb)))
-        multiprocess_scan_regionfile.q.put(s)
+        return (region_file, (except_type, except_class, extract_tb(tb)))
 
 
-def _mp_data_pool_init(d):
-    """ Function to initialize the multiprocessing in scan_dataset.
+def multiprocess_scan_batch(scan_function, batch):
+    """ Scans a list of files in a child process with scan_function.
 
     Inputs:
-    - d -- Dictionary containing the information to copy to the function of the child process.
+     - scan_function -- One of the multiprocess_scan_* functions, with all
+                        the arguments but the file to scan already bound
+     - batch -- List of files to scan
 
-    This function adds the queue to each of the child processes objects. This queue
-    is used to get the results from the child process. 
+    Return:
+     - results -- List with the results of scan_function
 
     """
 
-    assert isinstance(d, dict)
-    assert 'queue' in d
-    multiprocess_scan_data.q = d['queue']
+    return [scan_function(f) for f in batch]
 
 
-def _mp_regionset_pool_init(d):
-    """ Function to initialize the multiprocessing in scan_regionset.
-    
-    Inputs:
-    - d -- Dictionary containing the information to copy to the function of the child process.
+# Seconds between checks for Ctrl-C while waiting for results of the pool
+RESULT_WAIT_STEP = 0.1
 
-    This function adds the queue to each of the child processes objects. This queue
-    is used to get the results from the child process. 
-
-    """
-
-    assert isinstance(d, dict)
-    assert 'regionset' in d
-    assert 'queue' in d
-    assert 'entity_limit' in d
-    assert 'remove_entities' in d
-    multiprocess_scan_regionfile.regionset = d['regionset']
-    multiprocess_scan_regionfile.q = d['queue']
-    multiprocess_scan_regionfile.entity_limit = d['entity_limit']
-    multiprocess_scan_regionfile.remove_entities = d['remove_entities']
+# Maximum number of files sent at once to a child process
+MAX_JOBS_PER_WORKER = 5
 
 
 class AsyncScanner:
@@ -199,7 +183,7 @@ class AsyncScanner:
      - processes -- Integer with the number of child processes to use for the scan
      - scan_function -- Function used to scan the data
      - init_args -- These are the initialization arguments passed to __init__
-     - _mp_init_function -- Function used to initialize the child processes
+     - _mp_init_function -- Function used to initialize the child processes, or None
     
     To implement a scanner you have to override:
     update_str_last_scanned()
@@ -218,24 +202,18 @@ class AsyncScanner:
         self.processes = processes
         self.scan_function = scan_function
 
-        # Queue used by processes to pass results
-        self.queue = multiprocessing.SimpleQueue()
-        init_args.update({'queue': self.queue})
         # NOTE TO SELF: initargs doesn't handle kwargs, only args!
         # Pass a dict with all the args
         self.pool = multiprocessing.Pool(processes=processes,
                                          initializer=_mp_init_function,
                                          initargs=(init_args,))
 
-        # Recommended time to sleep between polls for results
-        self.SCAN_START_SLEEP_TIME = 0.001
-        self.SCAN_MIN_SLEEP_TIME = 1e-6
-        self.SCAN_MAX_SLEEP_TIME = 0.1
-        self.scan_sleep_time = self.SCAN_START_SLEEP_TIME
-        self.queries_without_results = 0
-        self.last_time = time()
-        self.MIN_QUERY_NUM = 1
-        self.MAX_QUERY_NUM = 5
+        # Iterator over the results, created in scan()
+        self._results = None
+        # Results already received from the pool but not yet returned
+        self._pending = deque()
+        # Set to True when the results iterator is exhausted
+        self._finished = False
 
         # Holds a friendly string with the name of the last file scanned
         self._str_last_scanned = None
@@ -248,13 +226,24 @@ class AsyncScanner:
         logging.debug("Starting scan in: %s", str(self))
         logging.debug("########################################################")
         logging.debug("########################################################")
-        # Tests indicate that smaller amount of jobs per worker make all type
-        # of scans faster
-        jobs_per_worker = 5
-        # jobs_per_worker = max(1, total_files // self.processes
-        self._results = self.pool.map_async(self.scan_function,
-                                            self.list_files_to_scan,
-                                            jobs_per_worker)
+        # Smaller amount of jobs per worker balance better the load when
+        # some files take a lot longer to scan than others
+        #
+        # NOTE: imap_unordered() with a chunksize bigger than 1 returns a
+        # generator which can't be read with a timeout, make the batches
+        # here instead.
+        #
+        # The results arrive one batch at a time, the batches are kept
+        # small so the progress is shown smoothly in big worlds.
+        files = self.list_files_to_scan
+        total_files = len(files)
+        jobs_per_worker = min(MAX_JOBS_PER_WORKER,
+                              max(1, total_files // (self.processes * 8)))
+        batches = [files[i:i + jobs_per_worker]
+                   for i in range(0, total_files, jobs_per_worker)]
+        self._results = self.pool.imap_unordered(partial(multiprocess_scan_batch,
+                                                         self.scan_function),
+                                                 batches)
 
         # No more tasks to the pool, exit the processes once the tasks are done
         self.pool.close()
@@ -262,27 +251,74 @@ class AsyncScanner:
         # See method
         self._str_last_scanned = ""
 
-    def get_last_result(self):
-        """ Return results of last file scanned. """
+    def get_last_result(self, timeout=None):
+        """ Return results of last file scanned.
 
-        q = self.queue
-        ds = self.data_structure
-        if not q.empty():
-            d = q.get()
-            if isinstance(d, tuple):
-                self.raise_child_exception(d)
-            # Copy it to the father process
-            ds._replace_in_data_structure(d)
-            ds._update_counts(d)
-            self.update_str_last_scanned(d)
-            # Got result! Reset it!
-            self.queries_without_results = 0
-            return d
-        else:
-            # Count amount of queries without result
-            self.queries_without_results += 1
+        Keyword arguments:
+         - timeout -- Seconds to wait for a result, None waits forever.
+
+        This method blocks until a new result arrives or the timeout
+        expires. If no result arrives in time or if the scan has finished
+        it returns None.
+
+        """
+
+        if self._finished:
             return None
 
+        if not self._pending:
+            try:
+                self._pending.extend(self._next_batch(timeout))
+            except StopIteration:
+                self._finished = True
+                return None
+            except multiprocessing.TimeoutError:
+                return None
+        d = self._pending.popleft()
+        if isinstance(d, tuple):
+            self.raise_child_exception(d)
+        # Copy it to the father process
+        ds = self.data_structure
+        ds._replace_in_data_structure(d)
+        ds._update_counts(d)
+        self.update_str_last_scanned(d)
+        return d
+
+    def _next_batch(self, timeout):
+        """ Return the next batch of results from the pool.
+
+        Keyword arguments:
+         - timeout -- Seconds to wait for the batch, None waits forever.
+
+        Waiting forever is done in steps of RESULT_WAIT_STEP seconds, in
+        windows Ctrl-C can't interrupt a wait without timeout.
+
+        """
+
+        if timeout is not None:
+            return self._results.next(timeout)
+        while True:
+            try:
+                return self._results.next(RESULT_WAIT_STEP)
+            except multiprocessing.TimeoutError:
+                pass
+
+    def drain(self):
+        """ Return a list with all the results that have arrived.
+
+        Blocks until at least one result arrives and then takes all
+        the results that are already waiting. Once the scan has finished
+        it returns an empty list.
+
+        """
+
+        results = []
+        d = self.get_last_result()
+        while d is not None:
+            results.append(d)
+            d = self.get_last_result(timeout=0)
+        return results
+
     def terminate(self):
         """ Terminate the pool, this will exit no matter what.
         """
@@ -304,40 +340,6 @@ class AsyncScanner:
         """ Updates the string that represents the last file scanned. """
         raise NotImplementedError
 
-    def sleep(self):
-        """ Sleep waiting for results.
-
-        This method will adjust automatically the sleep time. It will sleep less
-        when results arrive faster and more when they arrive slower.
-
-        """
-
-        # If the query number is outside of our range...
-        if not ((self.queries_without_results < self.MAX_QUERY_NUM) &
-                (self.queries_without_results > self.MIN_QUERY_NUM)):
-            # ... increase or decrease it to optimize queries
-            if self.queries_without_results < self.MIN_QUERY_NUM:
-                self.scan_sleep_time *= 0.5
-            elif self.queries_without_results > self.MAX_QUERY_NUM:
-                self.scan_sleep_time *= 2.0
-            # and don't go farther than max/min
-            if self.scan_sleep_time > self.SCAN_MAX_SLEEP_TIME:
-                logging.debug("Setting sleep time to MAX")
-                self.scan_sleep_time = self.SCAN_MAX_SLEEP_TIME
-            elif self.scan_sleep_time < self.SCAN_MIN_SLEEP_TIME:
-                logging.debug("Setting sleep time to MIN")
-                self.scan_sleep_time = self.SCAN_MIN_SLEEP_TIME
-
-        # Log how it's going
-        logging.debug("")
-        logging.debug("Nº of queries without result: %s", str(self.queries_without_results))
-        logging.debug("Current sleep time: %s", str(self.scan_sleep_time))
-        logging.debug("Time between calls to sleep(): %s", str(time() - self.last_time))
-        self.last_time = time()
-
-        # Sleep, let the other processes do their job
-        sleep(self.scan_sleep_time)
-
     @property
     def str_last_scanned(self):
         """ A friendly string with last scanned result. """
@@ -348,11 +350,12 @@ class AsyncScanner:
     def finished(self):
         """ Return True if the scan has finished.
         
-        It checks if the queue is empty and if the results are ready.
+        The scan has finished when all the results have been read from
+        the pool.
 
         """
 
-        return self._results.ready() and self.queue.empty()
+        return self._finished
 
     @property
     def results(self):
@@ -369,17 +372,10 @@ class AsyncScanner:
 
         """
 
-        q = self.queue
-        T = self.SCAN_WAIT_TIME
-        while not q.empty() or not self.finished:
-            sleep(T)
-            if not q.empty():
-                d = q.get()
-                if isinstance(d, tuple):
-                    self.raise_child_exception(d)
-                # Overwrite it in the data dict
-                self.replace_in_data_structure(d)
-                yield d
+        d = self.get_last_result()
+        while d is not None:
+            yield d
+            d = self.get_last_result()
 
     def __len__(self):
         return len(self.data_structure)
@@ -397,14 +393,11 @@ class AsyncDataScanner(AsyncScanner):
     def __init__(self, data_structure, processes):
         scan_function = multiprocess_scan_data
         init_args = {}
-        _mp_init_function = _mp_data_pool_init
+        _mp_init_function = None
 
         AsyncScanner.__init__(self, data_structure, processes, scan_function,
                               init_args, _mp_init_function)
 
-        # Recommended time to sleep between polls for results
-        self.scan_wait_time = 0.0001
-
     def update_str_last_scanned(self, data):
         self._str_last_scanned = data.filename
 
@@ -427,25 +420,61 @@ class AsyncRegionsetScanner(AsyncScanner):
                  remove_entities=False):
         assert isinstance(regionset, world.DataSet)
 
-        scan_function = multiprocess_scan_regionfile
-        _mp_init_function = _mp_regionset_pool_init
+        # The options are the same for all the region files, bind them
+        # here instead of storing them in the child processes
+        #
+        # Decompressing the chunks in threads only helps if there are
+        # cores left free by the child processes
+        scan_function = partial(multiprocess_scan_regionfile,
+                                entity_limit=entity_limit,
+                                remove_entities=remove_entities,
+                                threaded_decompression=processes < multiprocessing.cpu_count())
+        _mp_init_function = None
 
         init_args = {}
-        init_args['regionset'] = regionset
-        init_args['processes'] = processes
-        init_args['entity_limit'] = entity_limit
-        init_args['remove_entities'] = remove_entities
 
         AsyncScanner.__init__(self, regionset, processes, scan_function,
                               init_args, _mp_init_function)
 
-        # Recommended time to sleep between polls for results
-        self.scan_wait_time = 0.001
+        # Region files go from a few KB to several MB, scan the biggest
+        # first so no process is left alone with a big one at the end
+        sizes = [(_region_file_size(r), r) for r in self.list_files_to_scan]
+        sizes.sort(key=itemgetter(0), reverse=True)
+
+        # A region file without room for the header is too small, there
+        # is no need to send it to the child processes. Files of 0 bytes
+        # are empty region files, see RegionFile._parse_header()
+        header_size = 2 * region.SECTOR_LENGTH
+        self.list_files_to_scan = [r for size, r in sizes
+                                   if not 0 < size < header_size]
+        self._too_small = [r for size, r in sizes
+                           if 0 < size < header_size]
+
+    def scan(self):
+        """ Mark the too small region files and scan the rest. """
+
+        for r in self._too_small:
+            r.status = c.REGION_TOO_SMALL
+            r.scan_time = time()
+            r.scanned = True
+        # They are returned as results before the ones from the pool
+        self._pending.extend(self._too_small)
+
+        AsyncScanner.scan(self)
 
     def update_str_last_scanned(self, r):
         self._str_last_scanned = self.data_structure.get_name() + ": " + r.filename
 
 
+def _region_file_size(r):
+    """ Return the size in bytes of a ScannedRegionFile, 0 if unreadable. """
+
+    try:
+        return getsize(r.path)
+    except OSError:
+        return 0
+
+
 class AsyncWorldRegionScanner:
     """ Wrapper around the calls of AsyncScanner the whole world.
     
@@ -472,28 +501,17 @@ class AsyncWorldRegionScanner:
         self.entity_limit = entity_limit
         self.remove_entities = remove_entities
 
-        self.regionsets = copy(world_obj.regionsets)
+        self.regionsets = deque(world_obj.regionsets)
 
         self._current_regionset = None
-        self._str_last_scanned = None
 
         # Holds a friendly string with the name of the last file scanned
-        self.scan_wait_time = 0.001
-
-    def sleep(self):
-        """ Sleep waiting for results.
-
-        This method will sleep less when results arrive faster and
-        more when they arrive slower. See AsyncScanner.sleep().
-
-        """
-
-        self._current_regionset.sleep()
+        self._str_last_scanned = None
 
     def scan(self):
         """ Scan and fill the given regionset. """
 
-        cr = AsyncRegionsetScanner(self.regionsets.pop(0),
+        cr = AsyncRegionsetScanner(self.regionsets.popleft(),
                                    self.processes,
                                    self.entity_limit,
                                    self.remove_entities)
@@ -503,10 +521,15 @@ class AsyncWorldRegionScanner:
         # See method
         self._str_last_scanned = ""
 
-    def get_last_result(self):
+    def get_last_result(self, timeout=None):
         """ Return results of last region file scanned.
 
-        If there are left no scanned region files return None. The
+        Keyword arguments:
+         - timeout -- Seconds to wait for a result, None waits forever.
+
+        It blocks until a result arrives or the timeout expires. If no
+        result arrives in time or if there are left no scanned region
+        files return None. The
         ScannedRegionFile returned is the same instance in the regionset,
         don't modify it or you will modify the regionset results.
 
@@ -519,7 +542,7 @@ class AsyncWorldRegionScanner:
 
         if cr is not None:
             if not cr.finished:
-                r = cr.get_last_result()
+                r = cr.get_last_result(timeout)
                 self._str_last_scanned = cr.str_last_scanned
                 return r
             elif self.regionsets:
@@ -530,6 +553,25 @@ class AsyncWorldRegionScanner:
         else:
             return None
 
+    def drain(self):
+        """ Return a list with all the region files scanned since last call.
+
+        See AsyncScanner.drain(). It returns an empty list when the
+        current regionset has finished.
+
+        """
+
+        cr = self._current_regionset
+
+        if cr is not None:
+            if not cr.finished:
+                results = cr.drain()
+                self._str_last_scanned = cr.str_last_scanned
+                return results
+            elif self.regionsets:
+                self.scan()
+        return []
+
     def terminate(self):
         """ Terminates scan of the current RegionSet. """
 
@@ -550,7 +592,8 @@ class AsyncWorldRegionScanner:
     def finished(self):
         """ Return True if the scan has finished.
         
-        It checks if the queue is empty and if the results are ready.
+        It checks if there are regionsets left and if the current one
+        has finished.
 
         """
 
@@ -574,13 +617,19 @@ class AsyncWorldRegionScanner:
             # do things
         """
 
-        while not self.finished:
+        if self._current_regionset is None:
+            self.scan()
+
+        # Each AsyncRegionsetScanner blocks until its results arrive, chain
+        # them one regionset after another
+        while True:
             cr = self._current_regionset
-            if cr and not cr.finished:
-                for r in cr.results:
-                    yield r
-            elif self.regionsets:
-                self.scan()
+            for r in cr.results:
+                self._str_last_scanned = cr.str_last_scanned
+                yield r
+            if not self.regionsets:
+                break
+            self.scan()
 
     def __len__(self):
         l = 0
@@ -589,6 +638,10 @@ class AsyncWorldRegionScanner:
         return l
 
 
+# Minimum time in seconds between two redraws of the progress bar
+PBAR_REDRAW_INTERVAL = 0.05
+
+
 def console_scan_loop(scanners, scan_titles, verbose):
     """ Scan all the AsyncScanner object printing status to console.
     
@@ -612,19 +665,24 @@ def console_scan_loop(scanners, scan_titles, verbose):
                 try:
                     scanner.scan()
                     counter = 0
+                    last_redraw = 0
                     while not scanner.finished:
-                        scanner.sleep()
-                        result = scanner.get_last_result()
-                        if result:
+                        results = scanner.drain()
+                        for result in results:
                             logging.debug("\nNew result: {0}\n\nOneliner: {1}\n".format(result, result.oneliner_status))
                             counter += 1
-                            if not verbose:
-                                pbar.update(counter)
-                            else:
+                            if verbose:
                                 status = "(" + result.oneliner_status + ")"
                                 fn = result.filename
                                 fol = result.folder
                                 print("Scanned {0: <12} {1:.<43} {2}/{3}".format(join(fol, fn), status, counter, total))
+                        # Redrawing the bar is slow, specially on slow terminals,
+                        # redraw it at most once every PBAR_REDRAW_INTERVAL
+                        if results and not verbose:
+                            now = time()
+                            if now - last_redraw > PBAR_REDRAW_INTERVAL or counter == total:
+                                pbar.update(counter)
+                                last_redraw = now
                     if not verbose:
                         pbar.finish()
                 except KeyboardInterrupt as e:
@@ -656,9 +714,6 @@ def console_scan_world(world_obj, processes, entity_limit, remove_entities,
 
     """
 
-    # Time to wait between asking for results. Note that if the time is too big
-    # results will be waiting in the queue and the scan will take longer just
-    # because of this.
     w = world_obj
     # Scan the world directory
     print("World info:")
@@ -723,6 +778,11 @@ def console_scan_regionset(regionset, processes, entity_limit, remove_entities,
     regionset.scanned = True
 
 
+# Data files stored without gzip compression
+_UNCOMPRESSED_DATS = frozenset({'idcounts.dat'})
+_GZIP_MAGIC = b'\x1f\x8b'
+
+
 def scan_data(scanned_dat_file):
     """ Try to parse the nbt data file, and fill the scanned object.
 
@@ -732,22 +792,22 @@ def scan_data(scanned_dat_file):
     If something is wrong it will return a tuple with useful info
     to debug the problem.
 
-    NOTE: idcounts.dat (number of map files) is a nbt file and
-    is not compressed, we handle the  special case here.
+    NOTE: idcounts.dat (number of map files) is a nbt file and in
+    old versions is not compressed, we handle the special case here.
 
     """
 
     s = scanned_dat_file
     try:
-        if s.filename == 'idcounts.dat':
-            # TODO: This is ugly
-            # Open the file and create a buffer, this way
-            # NBT won't try to de-gzip the file
-            f = open(s.path)
-
-            _ = nbt.NBTFile(buffer=f)
+        # The files are small, read them at once and parse them from memory
+        with open(s.path, 'rb') as f:
+            data = f.read()
+        # Newer versions of the game gzip idcounts.dat too
+        if s.filename in _UNCOMPRESSED_DATS and not data.startswith(_GZIP_MAGIC):
+            # A buffer is parsed as it is, NBT won't try to de-gzip it
+            _ = nbt.NBTFile(buffer=BytesIO(data))
         else:
-            _ = nbt.NBTFile(filename=s.path)
+            _ = nbt.NBTFile(fileobj=BytesIO(data))
         s.status = c.DATAFILE_OK
     except MalformedFileError:
         s.status = c.DATAFILE_UNREADABLE
@@ -769,7 +829,8 @@ def scan_data(scanned_dat_file):
     return s
 
 
-def scan_region_file(scanned_regionfile_obj, entity_limit, remove_entities):
+def scan_region_file(scanned_regionfile_obj, entity_limit, remove_entities,
+                     threaded_decompression=False):
     """ Scan a region file filling the ScannedRegionFile object
 
     Inputs:
@@ -779,6 +840,9 @@ def scan_region_file(scanned_regionfile_obj, entity_limit, remove_entities):
      - remove_entities -- A boolean, defaults to False, to remove the entities while 
                          scanning. This is really handy because opening chunks with
                          too many entities for scanning can take minutes.
+     - threaded_decompression -- A boolean, defaults to False, to decompress the
+                         chunks in a pool of threads while they are scanned. Only
+                         faster if there are free cores.
 
     """
 
@@ -786,8 +850,14 @@ def scan_region_file(scanned_regionfile_obj, entity_limit, remove_entities):
         r = scanned_regionfile_obj
 
         # try to open the file and see if we can parse the header
+        #
+        # The whole file is read at once and parsed from memory, seeking
+        # and reading every header entry and chunk from the disk is a
+        # lot slower. It's opened for writing, like RegionFile does, so
+        # files that we can't fix are reported.
         try:
-            region_file = region.RegionFile(r.path)
+            with open(r.path, 'r+b') as f:
+                region_file = region.RegionFile(fileobj=BytesIO(f.read()))
         except region.NoRegionHeader:  # The region has no header
             r.status = c.REGION_TOO_SMALL
             r.scan_time = time()
@@ -806,64 +876,65 @@ def scan_region_file(scanned_regionfile_obj, entity_limit, remove_entities):
             r.scanned = True
             return r
 
-        for x in range(32):
-            for z in range(32):
-                # start the actual chunk scanning
-                g_coords = r.get_global_chunk_coords(x, z)
-                chunk, tup = scan_chunk(region_file,
-                                      (x, z),
-                                      g_coords,
-                                      entity_limit)
-                if tup:
-                    r[(x, z)] = tup
-                else:
-                    # chunk not created
-                    continue
-
-                if tup[c.TUPLE_STATUS] == c.CHUNK_OK:
-                    continue
-                elif tup[c.TUPLE_STATUS] == c.CHUNK_TOO_MANY_ENTITIES:
-                    # Deleting entities is in here because parsing a chunk
-                    # with thousands of wrong entities takes a long time,
-                    # and sometimes GiB of RAM, and once detected is better
-                    # to fix it at once.
-                    if remove_entities:
-                        world.delete_entities(region_file, x, z)
-                        print(("Deleted {0} entities in chunk"
-                               " ({1},{2}) of the region file: {3}").format(tup[c.TUPLE_NUM_ENTITIES], x, z, r.filename))
-                        # entities removed, change chunk status to OK
-                        r[(x, z)] = (0, c.CHUNK_OK)
-
-                    else:
-                        # This stores all the entities in a file,
-                        # comes handy sometimes.
-                        # ~ pretty_tree = chunk['Level']['Entities'].pretty_tree()
-                        # ~ name = "{2}.chunk.{0}.{1}.txt".format(x,z,split(region_file.filename)[1])
-                        # ~ archivo = open(name,'w')
-                        # ~ archivo.write(pretty_tree)
-                        pass
-                elif tup[c.TUPLE_STATUS] == c.CHUNK_CORRUPTED:
-                    pass
-                elif tup[c.TUPLE_STATUS] == c.CHUNK_WRONG_LOCATED:
-                    pass
-
-        # Now check for chunks sharing offsets:
-        # Please note! region.py will mark both overlapping chunks
-        # as bad (the one stepping outside his territory and the
-        # good one). Only wrong located chunk with a overlapping
-        # flag are really BAD chunks! Use this criterion to
-        # discriminate
-        #
-        # TODO: Why? I don't remember why
-        # TODO: Leave this to nbt, which code is much better than this
-
+        # Only scan the chunks present in the region header, asking
+        # for the rest would raise an InconceivedChunk for each of them
         metadata = region_file.metadata
-        sharing = [k for k in metadata if (metadata[k].status == region.STATUS_CHUNK_OVERLAPPING and
-                                           r[k][c.TUPLE_STATUS] == c.CHUNK_WRONG_LOCATED)]
-        shared_counter = 0
-        for k in sharing:
-            r[k] = (r[k][c.TUPLE_NUM_ENTITIES], c.CHUNK_SHARED_OFFSET)
-            shared_counter += 1
+        present = [k for k, m in metadata.items()
+                   if m.status != region.STATUS_CHUNK_NOT_CREATED]
+
+        # Chunks with too many entities, local coords and number of entities
+        too_many_entities = []
+
+        # Global coordinates of the first chunk of the region file
+        offset_x, offset_z = r.get_global_chunk_coords(0, 0)
+
+        for (x, z), blockdata in _decompress_chunks(region_file, present,
+                                                    threaded_decompression):
+            # start the actual chunk scanning
+            g_coords = (offset_x + x, offset_z + z)
+            chunk, tup = scan_chunk(region_file,
+                                    (x, z),
+                                    g_coords,
+                                    entity_limit,
+                                    blockdata)
+            if not tup:
+                # chunk not created
+                continue
+
+            status = tup[c.TUPLE_STATUS]
+            if status == c.CHUNK_TOO_MANY_ENTITIES:
+                too_many_entities.append(((x, z), tup[c.TUPLE_NUM_ENTITIES]))
+            elif (status == c.CHUNK_WRONG_LOCATED and
+                  metadata[x, z].status == region.STATUS_CHUNK_OVERLAPPING):
+                # Now check for chunks sharing offsets:
+                # Please note! region.py will mark both overlapping chunks
+                # as bad (the one stepping outside his territory and the
+                # good one). Only wrong located chunk with a overlapping
+                # flag are really BAD chunks! Use this criterion to
+                # discriminate
+                #
+                # TODO: Why? I don't remember why
+                # TODO: Leave this to nbt, which code is much better than this
+                tup = (tup[c.TUPLE_NUM_ENTITIES], c.CHUNK_SHARED_OFFSET)
+
+            # The counters of every status are updated by r[(x, z)], store
+            # the chunk only once
+            r[(x, z)] = tup
+
+        # Deleting entities is in here because parsing a chunk
+        # with thousands of wrong entities takes a long time,
+        # and sometimes GiB of RAM, and once detected is better
+        # to fix it at once.
+        if remove_entities and too_many_entities:
+            # region_file is in memory, write to the file in disk
+            disk_region_file = region.RegionFile(r.path)
+            for (x, z), num_entities in too_many_entities:
+                world.delete_entities(disk_region_file, x, z)
+                print(("Deleted {0} entities in chunk"
+                       " ({1},{2}) of the region file: {3}").format(num_entities, x, z, r.filename))
+                # entities removed, change chunk status to OK
+                r[(x, z)] = (0, c.CHUNK_OK)
+            disk_region_file.close()
 
         r.scan_time = time()
         r.status = c.REGION_OK
@@ -888,7 +959,51 @@ def scan_region_file(scanned_regionfile_obj, entity_limit, remove_entities):
         return r
 
 
-def scan_chunk(region_file, coords, global_coords, entity_limit):
+def _decompress_chunks(region_file, coords_list, threaded, lookahead=8):
+    """ Yields the coordinates of each chunk with a callable for its data.
+
+    Inputs:
+     - region_file -- nbt.RegionFile object
+     - coords_list -- List of tuples with local coordinates of the chunks
+     - threaded -- Boolean, decompress the chunks in a pool of threads
+     - lookahead -- Integer, number of chunks to decompress in advance
+
+    Return:
+     - (coords, blockdata) -- blockdata() returns the decompressed data of
+                              the chunk or raises the same errors as
+                              RegionFile.get_blockdata()
+
+    If threaded, the chunks are read in this thread and decompressed in a
+    pool of threads. zlib releases the GIL, so the next chunks are
+    decompressed while the current one is parsed. If not, every chunk is
+    decompressed when blockdata() is called.
+
+    """
+
+    if not threaded:
+        for x, z in coords_list:
+            yield (x, z), partial(region_file.get_blockdata, x, z)
+        return
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        for x, z in coords_list:
+            try:
+                raw = region_file.read_blockdata(x, z)
+                future = executor.submit(region_file.decompress_blockdata,
+                                         x, z, raw)
+            except region.RegionFileFormatError as e:
+                future = Future()
+                future.set_exception(e)
+            pending.append(((x, z), future.result))
+            if len(pending) > lookahead:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+
+
+def scan_chunk(region_file, coords, global_coords, entity_limit,
+               blockdata=None):
     """ Scans a chunk returning its status and number of entities.
 
     Keywords arguments:
@@ -896,9 +1011,11 @@ def scan_chunk(region_file, coords, global_coords, entity_limit):
     coords -- tuple containing the local (region) coordinates of the chunk
     global_coords -- tuple containing the global (world) coordinates of the chunk
     entity_limit -- the number of entities that is considered to be too many
+    blockdata -- callable returning the decompressed data of the chunk, if
+                 None the data is read with region_file.get_blockdata()
 
     Return:
-    chunk -- as a nbt file
+    chunk -- as a nbt.TAG_Compound lazily parsed, see lazy_nbt.py
     (num_entities, status) -- tuple with the number of entities of the chunk and
                               the status described by the CHUNK_* variables in
                               world.py
@@ -912,7 +1029,11 @@ def scan_chunk(region_file, coords, global_coords, entity_limit):
     el = entity_limit
 
     try:
-        chunk = region_file.get_chunk(*coords)
+        # Only a few tags are needed, don't parse the whole chunk
+        if blockdata is None:
+            chunk = lazy_nbt.get_chunk(region_file, *coords)
+        else:
+            chunk = lazy_nbt.get_chunk(region_file, *coords, data=blockdata())
         chunk_type = world.get_chunk_type(chunk)
 
         if chunk_type == c.LEVEL_DIR:
@@ -923,13 +1044,15 @@ def scan_chunk(region_file, coords, global_coords, entity_limit):
             try:
                 data_coords = world.get_chunk_data_coords(chunk)
                 
+                data_version = chunk["DataVersion"].value if "DataVersion" in chunk else 0
+
                 # Since snapshot 20w45a (1.17), entities MAY BE separated
-                if "DataVersion" in chunk and chunk["DataVersion"].value >= 2681 :
+                if data_version >= 2681 :
                     num_entities = None
                     
                     # Since snapshot 21w43a (1.18), "Level" tag doesn't exist anymore
                     # According to the wiki, an "entities" tag can still be there (But I've never seen it)
-                    if chunk["DataVersion"].value >= 2844 :
+                    if data_version >= 2844 :
                         if "entities" in chunk :
                             num_entities = len(chunk["entities"])
                     
@@ -957,16 +1080,12 @@ def scan_chunk(region_file, coords, global_coords, entity_limit):
                 # chunk with the mandatory tag Entities missing
                 status = c.CHUNK_MISSING_ENTITIES_TAG
                 chunk = None
-                data_coords = None
-                global_coords = world.get_global_chunk_coords(split(region_file.filename)[1], coords[0], coords[1])
                 num_entities = None
 
             except TypeError:
                 # TODO: This should another kind of error, it's now being handled as corrupted chunk
                 status = c.CHUNK_CORRUPTED
                 chunk = None
-                data_coords = None
-                global_coords = world.get_global_chunk_coords(split(region_file.filename)[1], coords[0], coords[1])
                 num_entities = None
 
         elif chunk_type == c.POI_DIR:
@@ -979,7 +1098,6 @@ def scan_chunk(region_file, coords, global_coords, entity_limit):
             # So, let's use "Sections" as a differentiating factor
         
             # POI chunk
-            data_coords = None
             num_entities = None
             status = c.CHUNK_OK
 
@@ -1014,40 +1132,16 @@ def scan_chunk(region_file, coords, global_coords, entity_limit):
     except InconceivedChunk:
         # chunk not created
         chunk = None
-        data_coords = None
         num_entities = None
         status = c.CHUNK_NOT_CREATED
 
-    except RegionHeaderError:
-        # corrupted chunk, because of region header
-        status = c.CHUNK_CORRUPTED
-        chunk = None
-        data_coords = None
-        global_coords = world.get_global_chunk_coords(split(region_file.filename)[1], coords[0], coords[1])
-        num_entities = None
-
-    except ChunkDataError:
-        # corrupted chunk, usually because of bad CRC in compression
-        status = c.CHUNK_CORRUPTED
-        chunk = None
-        data_coords = None
-        global_coords = world.get_global_chunk_coords(split(region_file.filename)[1], coords[0], coords[1])
-        num_entities = None
-
-    except ChunkHeaderError:
-        # corrupted chunk, error in the header of the chunk
-        status = c.CHUNK_CORRUPTED
-        chunk = None
-        data_coords = None
-        global_coords = world.get_global_chunk_coords(split(region_file.filename)[1], coords[0], coords[1])
-        num_entities = None
-
-    except UnicodeDecodeError:
-        # TODO: This should another kind of error, it's now being handled as corrupted chunk
+    except (RegionHeaderError, ChunkDataError, ChunkHeaderError, UnicodeDecodeError):
+        # corrupted chunk, because of the region header, a bad CRC in
+        # compression or an error in the header of the chunk
+        # TODO: UnicodeDecodeError should be another kind of error, it's
+        # now being handled as corrupted chunk
         status = c.CHUNK_CORRUPTED
         chunk = None
-        data_coords = None
-        global_coords = world.get_global_chunk_coords(split(region_file.filename)[1], coords[0], coords[1])
         num_entities = None
 
     return chunk, (num_entities, status) if status != c.CHUNK_NOT_CREATED else None
@@ -25,6 +25,7 @@ from glob import glob
 from os.path import join, split, exists, isfile
 from os import remove
 from shutil import copy
+from array import array
 import zlib
 
 import nbt.region as region
@@ -90,6 +91,11 @@ class ScannedRegionFile:
 
     """
 
+    # Values stored in the chunk arrays when there is no state tuple for
+    # the chunk and when its number of entities is None
+    _NO_STATUS = -128
+    _NO_ENTITIES = -1
+
     def __init__(self, path, scanned_time=None, folder=""):
         # general region file info
         self.path = path
@@ -99,10 +105,12 @@ class ScannedRegionFile:
         self.x, self.z = self.get_coords()
         self.coords = (self.x, self.z)
 
-        # dictionary storing all the state tuples of all the chunks
-        # in the region file, keys are the local coords of the chunk
-        # sometimes called header coords
-        self._chunks = {}
+        # the state tuples of all the chunks in the region file, stored
+        # in two arrays indexed by the local coords of the chunk (sometimes
+        # called header coords) as x * 32 + z. A dictionary of tuples takes
+        # ~100KB per region file, and all of them are kept in memory
+        self._statuses = array('b', [self._NO_STATUS]) * 1024
+        self._entities = array('q', [self._NO_ENTITIES]) * 1024
 
         # Dictionary containing counters to for all the chunks
         self._counts = {}
@@ -145,11 +153,23 @@ class ScannedRegionFile:
         return text
 
     def __getitem__(self, key):
-        return self._chunks[key]
+        x, z = key
+        i = x * 32 + z
+        status = self._statuses[i]
+        if status == self._NO_STATUS:
+            raise KeyError(key)
+        num_entities = self._entities[i]
+        if num_entities == self._NO_ENTITIES:
+            num_entities = None
+        return (num_entities, status)
 
     def __setitem__(self, key, value):
-        self._chunks[key] = value
-        self._counts[value[c.TUPLE_STATUS]] += 1
+        x, z = key
+        i = x * 32 + z
+        num_entities, status = value
+        self._statuses[i] = status
+        self._entities[i] = self._NO_ENTITIES if num_entities is None else num_entities
+        self._counts[status] += 1
 
     def get_coords(self):
         """ Returns the region file coordinates as two integers.
@@ -184,7 +204,8 @@ class ScannedRegionFile:
                     region file header as integer tuples
         """
 
-        return list(self._chunks.keys())
+        no_status = self._NO_STATUS
+        return [divmod(i, 32) for i, s in enumerate(self._statuses) if s != no_status]
 
     @property
     def has_problems(self):